@@ -1,49 +1,69 @@
+import asyncio
 import os
+import sys
+import httpx
 from openai import OpenAI
 from dotenv import load_dotenv
-from retrieval import get_wikipedia_chunks, embed_chunks, retrieve_relevant_chunks
+from retrieval import aget_or_build_context, aembed_query, aclose_async_client, retrieve_relevant_chunks
 from prompts import build_prompt, get_available_styles, format_context_preview
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# uvloop (libuv-based event loop) cuts scheduling overhead for the
+# concurrent embedding calls; it's not available on Windows
+if uvloop is not None and sys.platform != "win32":
+    uvloop.install()
+
+# Load Kong configuration once at startup
+load_dotenv()
+
+# Shared OpenAI client, built on first use and reused across questions so
+# the HTTPX connection pool (and its TLS sessions) stays warm
+_client = None
+
 
 def get_kong_client():
     """
-    Create an OpenAI client configured to use Kong API Gateway.
-    
+    Get the shared OpenAI client configured to use Kong API Gateway.
+
     Returns:
         OpenAI client configured for Kong
     """
-    load_dotenv()
-    
-    kong_token = os.getenv("KONG_API_TOKEN")
-    kong_base_url = os.getenv("KONG_BASE_URL")
-    
-    if not kong_token:
-        print("Error: KONG_API_TOKEN not found in .env file")
-        print("Please create a .env file with your Kong API token:")
-        print("KONG_API_TOKEN=your_kong_token_here")
-        exit(1)
-    
-    if not kong_base_url:
-        print("Error: KONG_BASE_URL not found in .env file")
-        print("Please create a .env file with your Kong base URL:")
-        print("KONG_BASE_URL=your_kong_base_url_here")
-        exit(1)
-    
-    client = OpenAI(
-        api_key=kong_token,
-        base_url=kong_base_url,
-        default_headers={"apikey": kong_token}
-    )
-    
-    return client
+    global _client
+
+    if _client is None:
+        kong_token = os.getenv("KONG_API_TOKEN")
+        kong_base_url = os.getenv("KONG_BASE_URL")
+
+        if not kong_token:
+            print("Error: KONG_API_TOKEN not found in .env file")
+            print("Please create a .env file with your Kong API token:")
+            print("KONG_API_TOKEN=your_kong_token_here")
+            exit(1)
+
+        if not kong_base_url:
+            print("Error: KONG_BASE_URL not found in .env file")
+            print("Please create a .env file with your Kong base URL:")
+            print("KONG_BASE_URL=your_kong_base_url_here")
+            exit(1)
+
+        _client = OpenAI(
+            api_key=kong_token,
+            base_url=kong_base_url,
+            default_headers={"apikey": kong_token},
+            http_client=httpx.Client(limits=httpx.Limits(max_keepalive_connections=20))
+        )
+
+    return _client
 
 
 def setup_kong():
     """
     Validate Kong API Gateway configuration.
     """
-    load_dotenv()
-    
     kong_token = os.getenv("KONG_API_TOKEN")
     kong_base_url = os.getenv("KONG_BASE_URL")
     
@@ -57,24 +77,27 @@ def setup_kong():
     print("Kong API Gateway configuration loaded successfully")
 
 
+# One-line description shown next to each style in the picker
+STYLE_DESCRIPTIONS = {
+    "default": "Normal factual responses",
+    "pirate": "Pirate-themed responses with 'arr' and 'matey'",
+    "kid": "Simple explanations suitable for children",
+    "bullets": "Organized bullet-point format"
+}
+
+
 def select_response_style():
     """
     Let the user choose a response style for the chatbot.
-    
+
     Returns:
         Selected style string
     """
     available_styles = get_available_styles()
-    
+
     print("\nChoose a response style:")
     for i, style in enumerate(available_styles, 1):
-        style_descriptions = {
-            "default": "Normal factual responses",
-            "pirate": "Pirate-themed responses with 'arr' and 'matey'",
-            "kid": "Simple explanations suitable for children", 
-            "bullets": "Organized bullet-point format"
-        }
-        description = style_descriptions.get(style, "")
+        description = STYLE_DESCRIPTIONS.get(style, "")
         print(f"{i}. {style} - {description}")
     
     while True:
@@ -95,32 +118,50 @@ def select_response_style():
             print("Please enter a valid number or press Enter for default")
 
 
-def process_question(question, style):
+async def _prepare_context(question):
+    """
+    Build (or reuse) the chunk context and embed the question concurrently.
+
+    Args:
+        question: User's question
+
+    Returns:
+        Tuple of ((chunks, chunk embeddings), question embedding)
+    """
+    return await asyncio.gather(
+        aget_or_build_context(question, max_chunks=10),
+        aembed_query(question)
+    )
+
+
+def process_question(question, style, runner):
     """
     Process a user question through the complete RAG pipeline.
-    
+
     Args:
         question: User's question
         style: Response style to use
+        runner: asyncio.Runner whose loop owns the async client's connections
     """
     try:
         print(f"\nSearching Wikipedia for: '{question}'...")
-        
-        # Step 1: Get Wikipedia chunks
-        chunks = get_wikipedia_chunks(question, max_chunks=10)
+
+        # Steps 1+2: Build (or reuse) the chunk context and embed the
+        # question, concurrently. All questions share the runner's loop —
+        # the async client's pooled connections are bound to it, so a
+        # fresh asyncio.run() per question would break every call after
+        # the first.
+        (chunks, embeddings), question_embedding = runner.run(_prepare_context(question))
         if not chunks:
             print("No relevant Wikipedia content found for your question.")
             return
-        
+
         print(f"Found {len(chunks)} Wikipedia chunks")
-        
-        # Step 2: Embed the chunks
-        print("Generating embeddings for Wikipedia content...")
-        embeddings = embed_chunks(chunks)
-        
+
         # Step 3: Retrieve relevant chunks for the question
         print("Finding most relevant content...")
-        relevant_chunks = retrieve_relevant_chunks(question, chunks, embeddings, top_k=3)
+        relevant_chunks = retrieve_relevant_chunks(question_embedding, chunks, embeddings,
+                                                   top_k=3, grade_question=question)
         
         if not relevant_chunks:
             print("Could not find relevant chunks for your question.")
@@ -133,20 +174,25 @@ def process_question(question, style):
         # Step 4: Build prompt with selected style
         messages = build_prompt(relevant_chunks, question, style)
         
-        # Step 5: Get response from OpenAI via Kong
+        # Step 5: Stream the response from OpenAI via Kong, printing tokens
+        # as they arrive so the user sees output after time-to-first-token
+        # rather than after the full generation
         print(f"\nGenerating {style} response...")
         client = get_kong_client()
         response = client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=messages,
-            temperature=0.3
+            temperature=0.3,
+            stream=True
         )
-        
-        # Extract and display the response
-        bot_response = response.choices[0].message.content
+
         print(f"\nBot ({style} style):")
         print("-" * 50)
-        print(bot_response)
+        for chunk in response:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                print(delta, end="", flush=True)
+        print()
         print("-" * 50)
         
     except Exception as e:
@@ -172,36 +218,42 @@ def main():
     print("You can ask questions about any topic and I'll search Wikipedia for answers.")
     print("Type 'exit' to quit or 'style' to change response style.\n")
     
-    # Main conversation loop
-    while True:
+    # Main conversation loop on one long-lived event loop, so the async
+    # client's connection pool stays valid across questions
+    with asyncio.Runner() as runner:
         try:
-            # Get user input
-            question = input("Ask a question (or 'exit'): ").strip()
-            
-            # Handle empty input
-            if not question:
-                print("Please enter a question or 'exit' to quit.")
-                continue
-            
-            # Handle exit command
-            if question.lower() in ['exit', 'quit', 'bye']:
-                print("Thanks for using the Wikipedia RAG Chatbot!")
-                break
-            
-            # Handle style change command
-            if question.lower() == 'style':
-                style = select_response_style()
-                continue
-            
-            # Process the question
-            process_question(question, style)
-            
-        except KeyboardInterrupt:
-            print("\n\nGoodbye!")
-            break
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            print("Please try again.")
+            while True:
+                try:
+                    # Get user input
+                    question = input("Ask a question (or 'exit'): ").strip()
+
+                    # Handle empty input
+                    if not question:
+                        print("Please enter a question or 'exit' to quit.")
+                        continue
+
+                    # Handle exit command
+                    if question.lower() in ['exit', 'quit', 'bye']:
+                        print("Thanks for using the Wikipedia RAG Chatbot!")
+                        break
+
+                    # Handle style change command
+                    if question.lower() == 'style':
+                        style = select_response_style()
+                        continue
+
+                    # Process the question
+                    process_question(question, style, runner)
+
+                except KeyboardInterrupt:
+                    print("\n\nGoodbye!")
+                    break
+                except Exception as e:
+                    print(f"Unexpected error: {e}")
+                    print("Please try again.")
+        finally:
+            # Close the async client on the loop its connections belong to
+            runner.run(aclose_async_client())
 
 
 if __name__ == "__main__":
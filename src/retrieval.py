@@ -1,176 +1,602 @@
+import asyncio
+import functools
+import hashlib
+import shelve
+from collections import OrderedDict
 import wikipedia
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
 import faiss
 import numpy as np
-from typing import List
+from typing import List, Tuple
 from dotenv import load_dotenv
 import re
+import json
 
+from prompts import build_grading_prompt
 
-def get_kong_client():
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Load Kong configuration once at import time rather than on every client lookup
+load_dotenv()
+
+# Precompiled whitespace-collapsing pattern used when cleaning article text
+_WHITESPACE = re.compile(r'\s+')
+
+# Token-based chunking parameters: ~500 tokens per chunk packs far more
+# evenly into ada-002's context than 800 characters, with a small overlap
+# so sentences split across a boundary stay retrievable
+CHUNK_TOKENS = 500
+CHUNK_TOKEN_OVERLAP = 50
+
+# Module-level clients, built lazily so importing this module doesn't
+# require Kong credentials. Reusing one client keeps the HTTPX connection
+# pool (and its TLS sessions) alive across embedding and chat calls.
+_client = None
+_async_client = None
+
+# On-disk embedding cache, keyed by sha1 of the chunk text so identical
+# chunks are never re-embedded across questions or restarts
+_EMBEDDING_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".embedding_cache")
+
+
+def _get_kong_config():
     """
-    Create an OpenAI client configured to use Kong API Gateway.
-    
+    Read the Kong token and base URL from the environment.
+
     Returns:
-        OpenAI client configured for Kong
+        Tuple of (kong_token, kong_base_url)
     """
-    load_dotenv()
-    
     kong_token = os.getenv("KONG_API_TOKEN")
     kong_base_url = os.getenv("KONG_BASE_URL")
-    
+
     if not kong_token or not kong_base_url:
         raise ValueError("Kong configuration missing. Please set KONG_API_TOKEN and KONG_BASE_URL in .env file")
-    
-    client = OpenAI(
-        api_key=kong_token,
-        base_url=kong_base_url,
-        default_headers={"apikey": kong_token}
-    )
-    
-    return client
+
+    return kong_token, kong_base_url
+
+
+def get_kong_client():
+    """
+    Get the shared OpenAI client configured to use Kong API Gateway.
+
+    Returns:
+        OpenAI client configured for Kong
+    """
+    global _client
+
+    if _client is None:
+        kong_token, kong_base_url = _get_kong_config()
+
+        _client = OpenAI(
+            api_key=kong_token,
+            base_url=kong_base_url,
+            default_headers={"apikey": kong_token},
+            http_client=httpx.Client(limits=httpx.Limits(max_keepalive_connections=20))
+        )
+
+    return _client
+
+
+def get_async_kong_client():
+    """
+    Get the shared async OpenAI client configured to use Kong API Gateway.
+
+    The client is created once and reused so that concurrent embedding
+    calls share one connection pool.
+
+    Returns:
+        AsyncOpenAI client configured for Kong
+    """
+    global _async_client
+
+    if _async_client is None:
+        kong_token, kong_base_url = _get_kong_config()
+
+        # A widened connection pool keeps the embedding fanout from
+        # queueing behind the SDK's small default limits, and HTTP/2
+        # multiplexes concurrent requests over one TLS session
+        _async_client = AsyncOpenAI(
+            api_key=kong_token,
+            base_url=kong_base_url,
+            default_headers={"apikey": kong_token},
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+                http2=True
+            )
+        )
+
+    return _async_client
+
+
+async def aclose_async_client():
+    """
+    Close the shared async client and drop it so the next use rebuilds it.
+
+    The client's pooled connections are bound to the event loop they were
+    opened on, so this must be awaited on that same loop before it shuts
+    down; callers that later need the client again get a fresh one.
+    """
+    global _async_client
+
+    if _async_client is not None:
+        client, _async_client = _async_client, None
+        await client.close()
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve_page_title(query: str) -> str:
+    """
+    Resolve a search query to its best-matching Wikipedia page title.
+
+    Cached so repeated questions on the same topic skip the search round-trip.
+
+    Args:
+        query: Search term for Wikipedia
+
+    Returns:
+        Page title of the top search result, or empty string if none found
+    """
+    search_results = wikipedia.search(query, results=1)
+    return search_results[0] if search_results else ""
+
+
+@functools.lru_cache(maxsize=256)
+def _fetch_page_content(title: str) -> str:
+    """
+    Fetch a Wikipedia page by title and return its cleaned content.
+
+    Cached so follow-up questions on the same page skip the fetch round-trip.
+
+    Args:
+        title: Exact Wikipedia page title
+
+    Returns:
+        Page content with whitespace normalized
+    """
+    page = wikipedia.page(title)
+    content = page.content
+
+    # Collapse all whitespace runs (including newlines) in a single pass
+    return _WHITESPACE.sub(' ', content).strip()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    """
+    Get the tokenizer used by the embedding model, loaded once.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _chunk_content(content: str, max_chunks: int) -> List[str]:
+    """
+    Split cleaned article content into chunks.
+
+    Uses token-based windows of CHUNK_TOKENS with CHUNK_TOKEN_OVERLAP
+    overlap when tiktoken is available, falling back to the original
+    800-character slicing otherwise.
+
+    Args:
+        content: Cleaned article text
+        max_chunks: Maximum number of chunks to return
+
+    Returns:
+        List of text chunks
+    """
+    chunks = []
+
+    if tiktoken is not None:
+        enc = _get_encoding()
+        ids = enc.encode(content)
+        step = CHUNK_TOKENS - CHUNK_TOKEN_OVERLAP
+
+        for i in range(0, len(ids), step):
+            chunk = enc.decode(ids[i:i + CHUNK_TOKENS]).strip()
+            if chunk:
+                chunks.append(chunk)
+
+            if len(chunks) >= max_chunks or i + CHUNK_TOKENS >= len(ids):
+                break
+
+        return chunks
+
+    # Fallback: chunks of approximately 800 characters. Each chunk is
+    # sliced from the content exactly once: the sentence boundary is found
+    # with a ranged rfind on the full string before slicing, and the
+    # cursor advances to the actual chunk end so no text is re-scanned.
+    chunk_size = 800
+    length = len(content)
+    i = 0
+
+    while i < length and len(chunks) < max_chunks:
+        end = min(i + chunk_size, length)
+
+        # Try to end chunks at sentence boundaries when possible, but only
+        # if the period falls in the latter part of the chunk
+        if end < length:
+            last_period = content.rfind('.', i + int(chunk_size * 0.7), end)
+            if last_period != -1:
+                end = last_period + 1
+
+        chunk = content[i:end].strip()
+        if chunk:
+            chunks.append(chunk)
+
+        i = end
+
+    return chunks
 
 
 def get_wikipedia_chunks(query: str, max_chunks: int = 10) -> List[str]:
     """
     Fetch Wikipedia article content and split it into chunks.
-    
+
     Args:
         query: Search term for Wikipedia
         max_chunks: Maximum number of chunks to return
-        
+
     Returns:
-        List of text chunks, each approximately 800 characters
+        List of text chunks of roughly CHUNK_TOKENS tokens each
     """
     try:
         # Search for the most relevant Wikipedia page
-        search_results = wikipedia.search(query, results=1)
-        if not search_results:
+        title = _resolve_page_title(query)
+        if not title:
             return []
-        
-        # Get the page content
-        page = wikipedia.page(search_results[0])
-        content = page.content
-        
-        # Clean the content by removing excessive whitespace and special characters
-        content = re.sub(r'\n+', ' ', content)
-        content = re.sub(r'\s+', ' ', content)
-        content = content.strip()
-        
-        # Split content into chunks of approximately 800 characters
-        chunks = []
-        chunk_size = 800
-        
-        for i in range(0, len(content), chunk_size):
-            chunk = content[i:i + chunk_size]
-            
-            # Try to end chunks at sentence boundaries when possible
-            if i + chunk_size < len(content):
-                last_period = chunk.rfind('.')
-                if last_period > chunk_size * 0.7:  # Only if period is in latter part of chunk
-                    chunk = chunk[:last_period + 1]
-            
-            if chunk.strip():
-                chunks.append(chunk.strip())
-                
-            if len(chunks) >= max_chunks:
-                break
-                
-        return chunks
-        
+
+        # Get the page content and split it
+        content = _fetch_page_content(title)
+        return _chunk_content(content, max_chunks)
+
+
     except wikipedia.exceptions.DisambiguationError as e:
-        # If multiple pages match, use the first suggestion
+        # If multiple pages match, fetch the first suggestion directly and
+        # reuse the normal chunking path
         try:
-            page = wikipedia.page(e.options[0])
-            content = page.content
-            return get_wikipedia_chunks(content, max_chunks)
-        except:
+            content = _fetch_page_content(e.options[0])
+            return _chunk_content(content, max_chunks)
+        except Exception:
             return []
-    except:
+    except Exception:
         return []
 
 
-def embed_chunks(chunks: List[str]) -> np.ndarray:
+# Maximum number of inputs sent per embeddings request (API limit is 2048)
+EMBED_BATCH_SIZE = 128
+
+# Below this many chunks, similarity search runs as a plain NumPy matmul;
+# FAISS index construction overhead only pays off above it
+FAISS_MIN_CHUNKS = 256
+
+# Index tiering: exact flat below SQ_MIN_CHUNKS, int8 scalar quantization
+# (4x smaller, SIMD int8 kernels) up to IVF_MIN_CHUNKS, then a compressed
+# IVF-PQ index to keep memory and search time in check
+SQ_MIN_CHUNKS = 2048
+IVF_MIN_CHUNKS = 10000
+
+# LLM grading kicks in when the cosine-score gap between the last kept
+# chunk and the first excluded one is below this margin
+GRADING_SCORE_GAP = 0.02
+
+# How many candidates to hand the LLM grader in its single call
+GRADING_CANDIDATES = 10
+
+# In-memory (chunks, embeddings) cache keyed by resolved page title, so
+# follow-up questions on the same topic skip fetching and embedding
+CONTEXT_CACHE_SIZE = 16
+_context_cache = OrderedDict()
+
+
+def _chunk_cache_key(chunk: str) -> str:
+    """
+    Content-addressed cache key for a chunk of text.
+    """
+    return hashlib.sha1(chunk.encode()).hexdigest()
+
+
+async def _aembed_batch(client, batch: List[str]) -> List[List[float]]:
+    """
+    Embed one batch of chunks with a single async API call.
+
+    Returns None if the request fails, so callers can substitute a
+    fallback without poisoning the cache.
+    """
+    try:
+        response = await client.embeddings.create(
+            input=batch,
+            model="text-embedding-ada-002"
+        )
+        # The API may return items out of order, so sort by index
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+    except Exception as e:
+        print(f"Failed to embed batch: {e}")
+        return None
+
+
+async def _aembed_texts(texts: List[str]) -> List[List[float]]:
+    """
+    Embed a list of texts, batching and issuing all batch requests concurrently.
+
+    Texts from failed batches come back as None.
+    """
+    client = get_async_kong_client()
+
+    batches = [texts[start:start + EMBED_BATCH_SIZE]
+               for start in range(0, len(texts), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*(_aembed_batch(client, batch) for batch in batches))
+
+    embeddings = []
+    for batch, batch_result in zip(batches, results):
+        if batch_result is None:
+            embeddings.extend(None for _ in batch)
+        else:
+            embeddings.extend(batch_result)
+    return embeddings
+
+
+async def aembed_chunks(chunks: List[str]) -> np.ndarray:
     """
     Generate embeddings for text chunks using OpenAI's API.
-    
+
+    Previously seen chunks are served from an on-disk cache keyed by
+    content hash; only cache misses are sent to the API, in batches of
+    EMBED_BATCH_SIZE issued concurrently.
+
     Args:
         chunks: List of text chunks to embed
-        
+
     Returns:
         NumPy array of shape (num_chunks, 1536) with dtype float32
     """
     if not chunks:
         return np.array([], dtype=np.float32).reshape(0, 1536)
-    
-    embeddings = []
-    
-    client = get_kong_client()
-    
-    for chunk in chunks:
-        try:
-            # Get embedding using OpenAI's text-embedding-ada-002 model via Kong
-            response = client.embeddings.create(
-                input=chunk,
-                model="text-embedding-ada-002"
-            )
-            embedding = response.data[0].embedding
-            embeddings.append(embedding)
-        except Exception as e:
-            # If embedding fails for a chunk, use zero vector
-            print(f"Failed to embed chunk: {e}")
-            embeddings.append([0.0] * 1536)
-    
-    # Convert to numpy array with the correct shape and dtype
-    embeddings_array = np.array(embeddings, dtype=np.float32)
+
+    keys = [_chunk_cache_key(chunk) for chunk in chunks]
+
+    # Preallocate the result array and fill rows in place — one C-level
+    # copy per embedding instead of a Python list of lists plus a final
+    # bulk conversion. Rows from failed batches stay zero.
+    embeddings_array = np.zeros((len(chunks), 1536), dtype=np.float32)
+
+    # Partition into cache hits and misses
+    misses = []
+    with shelve.open(_EMBEDDING_CACHE_PATH) as cache:
+        for i, key in enumerate(keys):
+            if key in cache:
+                embeddings_array[i] = cache[key]
+            else:
+                misses.append(i)
+
+    # Embed only the misses and write them back to the cache
+    if misses:
+        results = await _aembed_texts([chunks[i] for i in misses])
+        with shelve.open(_EMBEDDING_CACHE_PATH) as cache:
+            for i, embedding in zip(misses, results):
+                if embedding is not None:
+                    embeddings_array[i] = embedding
+                    cache[keys[i]] = embedding
+
+    # L2-normalize once so inner product == cosine similarity at query time
+    faiss.normalize_L2(embeddings_array)
     return embeddings_array
 
 
-def retrieve_relevant_chunks(question: str, chunks: List[str], embeddings: np.ndarray, top_k: int = 3) -> List[str]:
+async def aembed_query(question: str) -> np.ndarray:
     """
-    Retrieve the most relevant chunks for a given question using FAISS similarity search.
-    
+    Generate an embedding for a single query string.
+
     Args:
-        question: User's question to search against
+        question: Query text to embed
+
+    Returns:
+        NumPy array of shape (1, 1536) with dtype float32
+    """
+    client = get_async_kong_client()
+    response = await client.embeddings.create(
+        input=question,
+        model="text-embedding-ada-002"
+    )
+    return np.asarray([response.data[0].embedding], dtype=np.float32)
+
+
+async def aget_or_build_context(query: str, max_chunks: int = 10) -> Tuple[List[str], np.ndarray]:
+    """
+    Get the (chunks, embeddings) context for a query, building it on first use.
+
+    Contexts are cached in memory keyed by the resolved Wikipedia page
+    title (LRU-capped at CONTEXT_CACHE_SIZE), so follow-up questions about
+    the same topic skip the fetch and embedding path entirely.
+
+    Args:
+        query: Search term for Wikipedia
+        max_chunks: Maximum number of chunks in the context
+
+    Returns:
+        Tuple of (chunks, chunk embeddings)
+    """
+    try:
+        title = _resolve_page_title(query)
+    except Exception:
+        title = ""
+
+    if title and title in _context_cache:
+        _context_cache.move_to_end(title)
+        return _context_cache[title]
+
+    chunks = get_wikipedia_chunks(query, max_chunks)
+    embeddings = await aembed_chunks(chunks)
+
+    # Failed batches leave all-zero rows; don't cache those, or a
+    # transient embedding error would poison the topic for the whole
+    # session (the on-disk cache already skips failed embeddings)
+    if title and chunks and embeddings.any(axis=1).all():
+        _context_cache[title] = (chunks, embeddings)
+        if len(_context_cache) > CONTEXT_CACHE_SIZE:
+            _context_cache.popitem(last=False)
+
+    return chunks, embeddings
+
+
+def embed_chunks(chunks: List[str]) -> np.ndarray:
+    """
+    Synchronous wrapper around aembed_chunks.
+
+    Runs on a throwaway event loop, so the shared async client is closed
+    before the loop is torn down — its pooled connections are loop-bound
+    and would otherwise break the next call.
+
+    Args:
+        chunks: List of text chunks to embed
+
+    Returns:
+        NumPy array of shape (num_chunks, 1536) with dtype float32
+    """
+    async def _embed_and_close():
+        try:
+            return await aembed_chunks(chunks)
+        finally:
+            await aclose_async_client()
+
+    return asyncio.run(_embed_and_close())
+
+
+def build_index(embeddings: np.ndarray, index_path: str = None):
+    """
+    Build a FAISS inner-product index sized to the corpus.
+
+    Small corpora get an exact IndexFlatIP; mid-sized ones an int8
+    scalar-quantized index (4x less memory, SIMD int8 dot products); past
+    IVF_MIN_CHUNKS vectors an IVF-PQ index is trained instead, cutting
+    per-vector memory ~32x and narrowing each search to a handful of
+    inverted lists.
+
+    Args:
+        embeddings: L2-normalized embeddings, shape (num_chunks, dim)
+        index_path: Optional path to persist/reload the index
+
+    Returns:
+        FAISS index with the embeddings added
+    """
+    if index_path and os.path.exists(index_path):
+        return faiss.read_index(index_path)
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    dimension = embeddings.shape[1]
+
+    if embeddings.shape[0] < SQ_MIN_CHUNKS:
+        index = faiss.IndexFlatIP(dimension)
+    elif embeddings.shape[0] < IVF_MIN_CHUNKS:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit,
+                                           faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+    else:
+        index = faiss.index_factory(dimension, "IVF256,PQ48", faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+        index.nprobe = 16
+
+    index.add(embeddings)
+
+    if index_path:
+        faiss.write_index(index, index_path)
+
+    return index
+
+
+def grade_chunks(question: str, chunks: List[str]) -> List[str]:
+    """
+    Filter candidate chunks for relevance with a single LLM call.
+
+    One prompt grades the whole candidate set at once, so this never costs
+    more than one extra round-trip regardless of how many chunks there are.
+
+    Args:
+        question: User's question
+        chunks: Candidate text chunks to grade
+
+    Returns:
+        The relevant chunks, most relevant first; empty list if grading fails
+    """
+    if not chunks:
+        return []
+
+    try:
+        client = get_kong_client()
+        response = client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=build_grading_prompt(question, chunks),
+            temperature=0
+        )
+
+        indices = json.loads(response.choices[0].message.content)
+        return [chunks[i] for i in indices if isinstance(i, int) and 0 <= i < len(chunks)]
+
+    except Exception as e:
+        print(f"Failed to grade chunks: {e}")
+        return []
+
+
+def retrieve_relevant_chunks(question_embedding: np.ndarray, chunks: List[str], embeddings: np.ndarray,
+                             top_k: int = 3, grade_question: str = None) -> List[str]:
+    """
+    Retrieve the most relevant chunks for a given question using similarity search.
+
+    When grade_question is given and the similarity scores don't separate
+    the top_k cleanly from the rest, a wider candidate set is filtered by
+    one LLM grading call.
+
+    Args:
+        question_embedding: Pre-computed embedding of the user's question, shape (1, 1536)
         chunks: Original text chunks
         embeddings: Pre-computed embeddings for the chunks
         top_k: Number of top chunks to retrieve
-        
+        grade_question: Original question text, enabling LLM grading on low-confidence retrievals
+
     Returns:
         List of the most relevant text chunks
     """
     if not chunks or embeddings.shape[0] == 0:
         return []
-    
+
     try:
-        # Embed the question using Kong client
-        client = get_kong_client()
-        response = client.embeddings.create(
-            input=question,
-            model="text-embedding-ada-002"
-        )
-        question_embedding = np.array([response.data[0].embedding], dtype=np.float32)
-        
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        
-        # Add embeddings to the index
-        index.add(embeddings)
-        
-        # Search for similar chunks
+        # Normalize the query so inner product == cosine similarity
+        # (chunk embeddings are already normalized by aembed_chunks)
+        question_embedding = np.ascontiguousarray(question_embedding, dtype=np.float32)
+        faiss.normalize_L2(question_embedding)
+
         k = min(top_k, len(chunks))
-        distances, indices = index.search(question_embedding, k)
-        
-        # Return the corresponding chunks
-        relevant_chunks = []
-        for idx in indices[0]:
-            if 0 <= idx < len(chunks):
-                relevant_chunks.append(chunks[idx])
-        
-        return relevant_chunks
-        
+        # Pull extra candidates when grading is enabled so the confidence
+        # gap can be measured and the grader has a pool to filter
+        n = min(max(GRADING_CANDIDATES, k), len(chunks)) if grade_question is not None else k
+
+        if embeddings.shape[0] < FAISS_MIN_CHUNKS:
+            # For small corpora a single BLAS matmul beats building a
+            # FAISS index just to tear it down again
+            all_scores = embeddings @ question_embedding[0]
+            top = np.argpartition(-all_scores, n - 1)[:n]
+            indices = top[np.argsort(-all_scores[top])]
+            scores = all_scores[indices]
+        else:
+            # Build a FAISS index sized to the corpus and search it
+            index = build_index(embeddings)
+            distances, faiss_indices = index.search(question_embedding, n)
+            indices = [i for i in faiss_indices[0] if 0 <= i < len(chunks)]
+            scores = distances[0][:len(indices)]
+
+        # If the cutoff between kept and dropped chunks is ambiguous, let
+        # the LLM grade the whole candidate pool in one call
+        if (grade_question is not None and len(indices) > k
+                and scores[k - 1] - scores[k] < GRADING_SCORE_GAP):
+            graded = grade_chunks(grade_question, [chunks[i] for i in indices])
+            if graded:
+                return graded[:k]
+
+        return [chunks[i] for i in indices[:k]]
+
     except Exception as e:
         print(f"Failed to retrieve relevant chunks: {e}")
         # Return first few chunks as fallback